@@ -1,23 +1,86 @@
 import socket
+import selectors
 import threading
 import json
+import struct
 import sys
 import os
 import time
 import argparse
-from datetime import datetime
+
+try:
+    import orjson  # Faster JSON codec, works on bytes directly
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:
+    def json_dumps(obj):
+        return json.dumps(obj, ensure_ascii=False).encode('utf-8')  # Raw UTF-8 like orjson
+    json_loads = json.loads
+
+FRAME_HEADER = struct.Struct('<I')  # 4-byte little-endian payload length before every message
+SOCKET_BUFFER_SIZE = 256 * 1024  # Kernel send/receive buffer for the connection
+RECV_CHUNK_SIZE = 64 * 1024  # Bytes read per recv call
+# Largest message payload accepted from the server: its inbound frame limit plus room for the
+# sender, channel and keys it adds when forwarding. Its users and channels lists are far smaller
+MAX_FRAME_SIZE = 256 * 1024 + 4 * 1024
+
+_ts_cache = [0, ""]  # [epoch second, formatted "%H:%M:%S"] of the last timestamp shown
+
+def read_nickname(prompt):
+    """Prompt for a line on stdin, reading the fd a byte at a time so no later input is buffered away."""
+    if os.name == 'nt':
+        # The threaded loop reads with input() too, and the console reader decodes non-ASCII correctly
+        return input(prompt)
+    
+    print(prompt, end="", flush=True)
+    line = bytearray()
+    while True:
+        byte = os.read(sys.stdin.fileno(), 1)
+        if not byte or byte == b'\n':
+            break
+        line.extend(byte)
+    return line.decode(sys.stdin.encoding or 'utf-8', errors='replace').rstrip('\r')
 
 class ChatClient:
     def __init__(self, server_ip, server_port):
         self.server_ip = server_ip
         self.server_port = server_port
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Don't delay small frames
+        # Set before connect() so the TCP window scale fits the buffer
+        self.client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+        self.client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+        self.enable_keepalive()
         self.nickname = None
         self.current_channel = "general"
         self.running = False
         self.available_channels = ["general"]
-        self.lock = threading.Lock()
+        self.rxbuf = bytearray()  # Bytes received from the server that don't form a full frame yet
+        self.rxchunk = bytearray(RECV_CHUNK_SIZE)  # Reused for every recv
+        self.rxview = memoryview(self.rxchunk)
+        self.input_buffer = b""  # Typed bytes not yet terminated by a newline
+        self.receive_thread = None  # Only used when input can't share the event loop
+        self.message_handlers = {  # {message type: handler}
+            'chat': self.on_chat,
+            'private': self.on_private,
+            'info': self.on_info,
+            'error': self.on_error,
+            'channels_list': self.on_channels_list,
+            'users_list': self.on_users_list,
+            'server_shutdown': self.on_server_shutdown,
+        }
+        
+    def enable_keepalive(self):
+        """Enable TCP keepalive so a vanished server is detected."""
+        self.client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
         
+        # Linux-only tuning: probe after 60s idle, every 15s, give up after 4 misses
+        # or when sent data stays unacknowledged for 2 minutes
+        for option, value in (("TCP_KEEPIDLE", 60), ("TCP_KEEPINTVL", 15),
+                              ("TCP_KEEPCNT", 4), ("TCP_USER_TIMEOUT", 120000)):
+            if hasattr(socket, option):
+                self.client_socket.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+    
     def connect(self):
         """Connect to the chat server."""
         try:
@@ -50,39 +113,103 @@ class ChatClient:
             print("Not connected to server.")
             return
         
-        # Start a thread to receive messages
-        receive_thread = threading.Thread(target=self.receive_messages)
-        receive_thread.daemon = True
-        receive_thread.start()
-        
         self.show_help()
         
-        # Main loop for sending messages
+        try:
+            if os.name == 'nt':
+                # select() only works with sockets on Windows
+                self.run_threaded()
+            else:
+                self.run_event_loop()
+        except KeyboardInterrupt:
+            self.disconnect()
+    
+    def run_threaded(self):
+        """Read input and messages on separate threads, for stdin that can't be selected on."""
+        self.receive_thread = threading.Thread(target=self.receive_messages)
+        self.receive_thread.daemon = True
+        self.receive_thread.start()
+        
         while self.running:
             try:
-                user_input = input()
-                
-                if not user_input:
-                    continue
-                
-                if user_input.startswith('/'):
-                    self.process_command(user_input)
-                else:
-                    # Regular message to current channel
-                    chat_msg = {
-                        'type': 'chat',
-                        'content': user_input,
-                        'echo': True  # See your own messages
-                    }
-                    self.send_message(chat_msg)
-            
-            except KeyboardInterrupt:
+                self.handle_input(input())
+            except EOFError:
+                self.disconnect()
+            except Exception as e:
+                print(f"Error: {e}")
+    
+    def run_event_loop(self):
+        """Wait for server messages and user input together on a single thread."""
+        selector = selectors.DefaultSelector()
+        selector.register(self.client_socket, selectors.EVENT_READ, self.on_socket_ready)
+        try:
+            selector.register(sys.stdin, selectors.EVENT_READ, self.on_input_ready)
+        except OSError:
+            # epoll refuses regular files, e.g. input redirected from a script
+            selector.close()
+            self.run_threaded()
+            return
+        
+        # Buffer output and flush once per wakeup instead of once per printed line
+        line_buffering = sys.stdout.line_buffering
+        sys.stdout.reconfigure(line_buffering=False)
+        try:
+            while self.running:
+                for key, _ in selector.select():
+                    if not self.running:
+                        break
+                    callback = key.data
+                    callback()
+                sys.stdout.flush()
+        finally:
+            selector.close()
+            sys.stdout.reconfigure(line_buffering=line_buffering)
+    
+    def on_socket_ready(self):
+        """Handle data arriving from the server."""
+        try:
+            self.receive_data()
+        except Exception as e:
+            if self.running:
+                print(f"Error receiving messages: {e}")
                 self.disconnect()
+    
+    def on_input_ready(self):
+        """Handle every complete line the user has typed."""
+        # Read the raw fd, the nickname prompt leaves nothing behind in Python's stdin buffer
+        data = os.read(sys.stdin.fileno(), 4096)
+        if data:
+            *lines, self.input_buffer = (self.input_buffer + data).split(b'\n')
+        else:
+            # End of input, still send a last line that has no newline
+            lines, self.input_buffer = [self.input_buffer], b""
+        
+        for line in lines:
+            if not self.running:
                 break
+            try:
+                self.handle_input(line.decode(sys.stdin.encoding or 'utf-8', errors='replace').rstrip('\r'))
             except Exception as e:
                 print(f"Error: {e}")
-                if not self.running:
-                    break
+        
+        if not data and self.running:
+            self.disconnect()
+    
+    def handle_input(self, user_input):
+        """Handle one line typed by the user."""
+        if not user_input:
+            return
+        
+        if user_input.startswith('/'):
+            self.process_command(user_input)
+        else:
+            # Regular message to current channel
+            chat_msg = {
+                'type': 'chat',
+                'content': user_input,
+                'echo': True  # See your own messages
+            }
+            self.send_message(chat_msg)
     
     def process_command(self, command):
         """Process a command entered by the user."""
@@ -164,68 +291,109 @@ class ChatClient:
         print("------------------------\n")
     
     def receive_messages(self):
-        """Continuously receive and handle messages from the server."""
-        buffer = ""
-        
-        while self.running:
+        """Receive and handle messages until the server closes the connection."""
+        while True:  # Keeps going after disconnect() so replies to our last commands are shown
             try:
-                data = self.client_socket.recv(4096).decode('utf-8')
-                if not data:
-                    print("Disconnected from server.")
-                    self.disconnect()
+                if not self.receive_data():
                     break
-                
-                buffer += data
-                
-                while '\n' in buffer:
-                    message_json, buffer = buffer.split('\n', 1)
-                    message = json.loads(message_json)
-                    self.handle_message(message)
-            
-            except json.JSONDecodeError:
-                print("Error: Received invalid message format")
             except Exception as e:
                 if self.running:
                     print(f"Error receiving messages: {e}")
                 break
     
-    def handle_message(self, message):
-        """Handle a message received from the server."""
-        msg_type = message.get('type', '')
-        sender = message.get('sender', 'Unknown')
-        content = message.get('content', '')
-        timestamp = message.get('timestamp', datetime.now().strftime("%H:%M:%S"))
-        
-        if msg_type == 'chat':
-            channel = message.get('recipient', self.current_channel)
-            print(f"[{timestamp}] [{channel}] {sender}: {content}")
-        
-        elif msg_type == 'private':
-            print(f"[{timestamp}] [PM] {sender} -> {message.get('recipient', 'you')}: {content}")
-        
-        elif msg_type == 'info':
-            print(f"[{timestamp}] [INFO] {content}")
-        
-        elif msg_type == 'error':
-            print(f"[{timestamp}] [ERROR] {content}")
+    def receive_data(self):
+        """Read available data from the server and handle every complete message. Returns False on disconnect."""
+        nbytes = self.client_socket.recv_into(self.rxchunk)
+        if not nbytes:
+            if self.running:
+                print("Disconnected from server.")
+                self.disconnect()
+            return False
         
-        elif msg_type == 'channels_list':
-            with self.lock:
-                self.available_channels = content
-            print(f"[{timestamp}] Available channels: {', '.join(content)}")
+        rxbuf = self.rxbuf
+        rxbuf.extend(self.rxview[:nbytes])
+        relax = False
         
-        elif msg_type == 'users_list':
-            print(f"[{timestamp}] Users in channel: {', '.join(content)}")
+        while len(rxbuf) >= FRAME_HEADER.size:
+            length = FRAME_HEADER.unpack_from(rxbuf)[0]
+            if length > MAX_FRAME_SIZE:
+                # Never buffer an unbounded frame
+                print(f"Error: Received a {length} byte message, larger than allowed")
+                self.disconnect()
+                return False
+            
+            end = FRAME_HEADER.size + length
+            if len(rxbuf) < end:
+                break  # Wait for the rest of the frame
+            message_json = rxbuf[FRAME_HEADER.size:end]  # json_loads takes the bytearray slice as is
+            del rxbuf[:end]
+            relax = relax or end > RECV_CHUNK_SIZE
+            try:
+                message = json_loads(message_json)
+            except json.JSONDecodeError:
+                print("Error: Received invalid message format")
+                continue
+            self.handle_message(message)
         
-        elif msg_type == 'server_shutdown':
-            print(f"[{timestamp}] [SERVER] {content}")
-            self.disconnect()
+        if relax:
+            # A large frame grew the buffer, copy the tail so the memory goes back to the allocator
+            self.rxbuf = bytearray(rxbuf)
+        return True
+    
+    def handle_message(self, message):
+        """Handle a message received from the server."""
+        handler = self.message_handlers.get(message.get('type', ''))
+        if handler:
+            sender = message.get('sender', 'Unknown')
+            content = message.get('content', '')
+            timestamp = message.get('timestamp') or self.current_timestamp()
+            handler(message, timestamp, sender, content)
+    
+    @staticmethod
+    def current_timestamp():
+        """Return the current time as HH:MM:SS, formatting at most once per second."""
+        now = int(time.time())
+        if now != _ts_cache[0]:
+            _ts_cache[0] = now
+            _ts_cache[1] = time.strftime("%H:%M:%S", time.localtime(now))
+        return _ts_cache[1]
+    
+    def on_chat(self, message, timestamp, sender, content):
+        """Show a chat message from a channel."""
+        channel = message.get('recipient', self.current_channel)
+        sys.stdout.write(f"[{timestamp}] [{channel}] {sender}: {content}\n")
+    
+    def on_private(self, message, timestamp, sender, content):
+        """Show a private message."""
+        sys.stdout.write(f"[{timestamp}] [PM] {sender} -> {message.get('recipient', 'you')}: {content}\n")
+    
+    def on_info(self, message, timestamp, sender, content):
+        """Show an informational message from the server."""
+        sys.stdout.write(f"[{timestamp}] [INFO] {content}\n")
+    
+    def on_error(self, message, timestamp, sender, content):
+        """Show an error reported by the server."""
+        sys.stdout.write(f"[{timestamp}] [ERROR] {content}\n")
+    
+    def on_channels_list(self, message, timestamp, sender, content):
+        """Update and show the available channels."""
+        self.available_channels = content
+        sys.stdout.write(f"[{timestamp}] Available channels: {', '.join(content)}\n")
+    
+    def on_users_list(self, message, timestamp, sender, content):
+        """Show the users in a channel."""
+        sys.stdout.write(f"[{timestamp}] Users in channel: {', '.join(content)}\n")
+    
+    def on_server_shutdown(self, message, timestamp, sender, content):
+        """Show the shutdown notice and disconnect."""
+        sys.stdout.write(f"[{timestamp}] [SERVER] {content}\n")
+        self.disconnect()
     
     def send_message(self, message):
         """Send a message to the server."""
         try:
-            message_json = json.dumps(message)
-            message_bytes = (message_json + '\n').encode('utf-8')
+            payload = json_dumps(message)
+            message_bytes = FRAME_HEADER.pack(len(payload)) + payload
             self.client_socket.sendall(message_bytes)
         except Exception as e:
             if self.running:
@@ -234,9 +402,24 @@ class ChatClient:
     
     def disconnect(self):
         """Disconnect from the server and clean up."""
+        if not self.running:
+            return  # Already disconnecting, e.g. a message handled while draining asked again
         self.running = False
         print("Disconnecting from server...")
         
+        try:
+            # Half-close and keep handling messages until the server finishes. Closing with unread
+            # data would send a reset, which can make the server discard what we sent just before.
+            self.client_socket.shutdown(socket.SHUT_WR)
+            if self.receive_thread and self.receive_thread is not threading.current_thread():
+                self.receive_thread.join(1)  # It reads until the server closes
+            else:
+                self.client_socket.settimeout(1)
+                while self.receive_data():
+                    pass
+        except:
+            pass
+        
         try:
             self.client_socket.close()
         except:
@@ -252,7 +435,7 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     print("=== Multi-User Chat Client ===")
-    nickname = input("Enter your nickname: ")
+    nickname = read_nickname("Enter your nickname: ")
     
     client = ChatClient(args.server, args.port)
     
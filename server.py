@@ -1,8 +1,34 @@
 import socket
-import threading
+import selectors
 import json
+import struct
 import time
-from datetime import datetime
+from collections import deque
+from itertools import islice
+
+try:
+    import orjson  # Faster JSON codec, works on bytes directly
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:
+    def json_dumps(obj):
+        # Raw UTF-8 like orjson, so forwarding text never grows it into \u escapes
+        return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+    json_loads = json.loads
+
+FRAME_HEADER = struct.Struct('<I')  # 4-byte little-endian payload length before every message
+MAX_OUTQ_BYTES = 1024 * 1024  # Drop clients that fall this far behind on their output
+SENDMSG_MAX_BUFFERS = 64  # Queued buffers gathered into a single sendmsg call
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')  # Missing on Windows
+MAX_CONNECTIONS = 256  # Stop accepting beyond this and let the listen backlog push back
+REGISTRATION_TIMEOUT = 10  # Seconds a new connection gets to register before it is dropped
+SOCKET_BUFFER_SIZE = 256 * 1024  # Kernel send/receive buffer per socket
+RECV_CHUNK_SIZE = 64 * 1024  # Bytes read per recv call
+MAX_FRAME_SIZE = 256 * 1024  # Largest message payload accepted from a client
+MAX_NAME_LENGTH = 32  # Longest nickname or channel name, in characters
+MAX_CHANNELS = 256  # Keeps the channels list every client receives bounded
+# Frames we send are forwarded client frames plus a small envelope, or lists of at most
+# max(MAX_CONNECTIONS, MAX_CHANNELS) names (~34 KiB); client.MAX_FRAME_SIZE must cover both
 
 class ChatServer:
     def __init__(self, host='0.0.0.0', port=9090):
@@ -10,40 +36,62 @@ class ChatServer:
         self.port = port
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Don't delay small frames
+        # Set before listen() so accepted sockets inherit them and the TCP window scale fits the buffer
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+        self.selector = selectors.DefaultSelector()
+        self.connections = {}  # {client_socket: {"address": address, "rxbuf": bytearray, "outq": deque, "outq_bytes": int, "accepted": time}}
         self.clients = {}  # {client_socket: {"nickname": nickname, "channel": channel}}
+        self.nicknames = {}  # {nickname: client_socket}
         self.channels = {"general": set()}  # Default channel
-        self.lock = threading.Lock()
+        self.rxchunk = bytearray(RECV_CHUNK_SIZE)  # Reused for every recv, the loop only reads one socket at a time
+        self.rxview = memoryview(self.rxchunk)
+        self.message_handlers = {  # {message type: handler}
+            'chat': self.process_chat,
+            'private': self.process_private,
+            'join_channel': self.process_join_channel,
+            'create_channel': self.process_create_channel,
+            'list_users': self.process_list_users,
+        }
+        self.accepting = False
         self.running = True
         
     def start_server(self):
-        """Start the server and begin listening for connections."""
+        """Start the server and run the event loop."""
         try:
             self.server_socket.bind((self.host, self.port))
             self.server_socket.listen(100)  # Queue up to 100 connections
-            print(f"[SERVER] Started on {self.host}:{self.port}")
-            
-            # Start a thread to monitor server health
-            health_thread = threading.Thread(target=self.monitor_health)
-            health_thread.daemon = True
-            health_thread.start()
-            
-            while self.running:
-                try:
-                    client_socket, client_address = self.server_socket.accept()
-                    print(f"[SERVER] New connection from {client_address}")
-                    
-                    # Start a new thread to handle this client
-                    client_thread = threading.Thread(target=self.handle_client, args=(client_socket, client_address))
-                    client_thread.daemon = True
-                    client_thread.start()
-                    
-                except Exception as e:
-                    if self.running:
-                        print(f"[SERVER] Error accepting connection: {e}")
-                    else:
-                        break
+            self.server_socket.setblocking(False)
+            self.update_accepting()
         except Exception as e:
             print(f"[SERVER] Failed to start server: {e}")
+            self.shutdown()
+            return
+        print(f"[SERVER] Started on {self.host}:{self.port}")
+        
+        try:
+            # One thread serves every connection; the selector wakes us when a socket is ready
+            next_health_check = next_reap = time.monotonic()
+            while self.running:
+                now = time.monotonic()
+                if now >= next_health_check:
+                    self.monitor_health()
+                    next_health_check = now + 60  # Check every minute
+                if now >= next_reap:
+                    self.reap_unregistered(now)
+                    next_reap = now + REGISTRATION_TIMEOUT
+                
+                timeout = min(next_health_check, next_reap) - now
+                for key, mask in self.selector.select(timeout=timeout):
+                    callback = key.data
+                    try:
+                        callback(key.fileobj, mask)
+                    except Exception as e:
+                        # Contain the failure to the one connection, like a lost client thread used to be
+                        print(f"[SERVER] Error in event handler: {e}")
+                        if key.fileobj is not self.server_socket:
+                            self.remove_client(key.fileobj)
         finally:
             self.shutdown()
     
@@ -57,189 +105,288 @@ class ChatServer:
         self.broadcast(shutdown_msg)
         
         # Close all client connections
-        with self.lock:
-            for client_socket in list(self.clients.keys()):
-                try:
-                    client_socket.close()
-                except:
-                    pass
-            self.clients.clear()
+        for client_socket in list(self.connections.keys()):
+            try:
+                client_socket.close()
+            except:
+                pass
+        self.connections.clear()
+        self.clients.clear()
+        self.nicknames.clear()
         
         # Close server socket
         try:
             self.server_socket.close()
         except:
             pass
+        self.selector.close()
         print("[SERVER] Shutdown complete")
     
     def monitor_health(self):
-        """Monitor server health and log statistics periodically."""
-        while self.running:
-            with self.lock:
-                client_count = len(self.clients)
-                channel_stats = {channel: len(members) for channel, members in self.channels.items()}
-            
-            print(f"[HEALTH] Active clients: {client_count}")
-            print(f"[HEALTH] Channel statistics: {channel_stats}")
-            
-            time.sleep(60)  # Check every minute
+        """Log server health statistics."""
+        client_count = len(self.clients)
+        channel_stats = {channel: len(members) for channel, members in self.channels.items()}
+        
+        print(f"[HEALTH] Active clients: {client_count}")
+        print(f"[HEALTH] Channel statistics: {channel_stats}")
     
-    def handle_client(self, client_socket, address):
-        """Handle communication with a client."""
+    def accept_client(self, server_socket, mask):
+        """Accept a new connection and start watching it for data."""
         try:
-            # First message should be the registration with nickname
-            registration = self.receive_message(client_socket)
-            if not registration or registration['type'] != 'register':
-                client_socket.close()
-                return
-            
-            nickname = registration['content']
-            
-            # Check if nickname is already in use
-            with self.lock:
-                if any(client_info['nickname'] == nickname for client_info in self.clients.values()):
-                    self.send_message(client_socket, self.create_message(
-                        "SERVER", nickname, "error", "Nickname already in use. Please choose another one."
-                    ))
-                    client_socket.close()
-                    return
-                
-                # Register the client
-                self.clients[client_socket] = {"nickname": nickname, "channel": "general"}
-                self.channels["general"].add(client_socket)
-            
-            # Notify the client of successful registration
-            welcome_msg = self.create_message("SERVER", nickname, "info", f"Welcome {nickname}! You are in the 'general' channel.")
-            self.send_message(client_socket, welcome_msg)
+            client_socket, client_address = server_socket.accept()
+        except Exception as e:
+            print(f"[SERVER] Error accepting connection: {e}")
+            return
+        
+        print(f"[SERVER] New connection from {client_address}")
+        
+        try:
+            # Chat frames are small, send them immediately instead of waiting on Nagle
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # Reap peers that vanish, including ones that never register
+            self.enable_keepalive(client_socket)
             
-            # Notify other clients
-            join_msg = self.create_message("SERVER", "all", "info", f"{nickname} has joined the chat.")
-            self.broadcast(join_msg, exclude=client_socket)
+            # Never block the event loop on one client; unsent output waits in the client's queue
+            client_socket.setblocking(False)
+            self.selector.register(client_socket, selectors.EVENT_READ, self.handle_client)
+        except OSError as e:
+            # e.g. EINVAL on BSD when the peer reset before we got here
+            print(f"[SERVER] Error setting up connection from {client_address}: {e}")
+            client_socket.close()
+            return
+        
+        self.connections[client_socket] = {
+            "address": client_address,
+            "rxbuf": bytearray(),
+            "outq": deque(),
+            "outq_bytes": 0,
+            "accepted": time.monotonic(),
+        }
+        self.update_accepting()
+    
+    def reap_unregistered(self, now):
+        """Drop connections that have not registered within REGISTRATION_TIMEOUT."""
+        for client_socket, connection in tuple(self.connections.items()):
+            if client_socket not in self.clients and now - connection['accepted'] > REGISTRATION_TIMEOUT:
+                print(f"[SERVER] Dropping {connection['address']}: no registration received")
+                self.remove_client(client_socket)
+    
+    def update_accepting(self):
+        """Watch the listening socket only while below the connection limit."""
+        accepting = self.running and len(self.connections) < MAX_CONNECTIONS
+        if accepting == self.accepting:
+            return
+        
+        if accepting:
+            self.selector.register(self.server_socket, selectors.EVENT_READ, self.accept_client)
+        else:
+            self.selector.unregister(self.server_socket)
+            print(f"[SERVER] Connection limit of {MAX_CONNECTIONS} reached, pausing accepts")
+        self.accepting = accepting
+    
+    def handle_client(self, client_socket, mask):
+        """Handle a client socket that is ready for reading or writing."""
+        connection = self.connections.get(client_socket)
+        if connection is None:
+            return  # Removed earlier in this round of events
+        
+        if mask & selectors.EVENT_WRITE:
+            self.flush_client(client_socket)
+        if not mask & selectors.EVENT_READ:
+            return
+        
+        address = connection['address']
+        try:
+            messages, connected = self.receive_messages(client_socket, connection)
             
-            # Send list of available channels
-            channels_list = list(self.channels.keys())
-            channels_msg = self.create_message("SERVER", nickname, "channels_list", channels_list)
-            self.send_message(client_socket, channels_msg)
+            for message in messages:
+                if client_socket not in self.connections:
+                    return  # Dropped while handling an earlier message
+                if client_socket not in self.clients:
+                    # First message should be the registration with nickname
+                    if not self.register_client(client_socket, message):
+                        return
+                else:
+                    self.process_message(client_socket, message)
             
-            # Main loop to receive messages from this client
-            while self.running:
-                message = self.receive_message(client_socket)
-                if not message:
-                    break
-                
-                self.process_message(client_socket, message)
+            # Drop the client only after handling what it sent before the error
+            if not connected:
+                self.remove_client(client_socket)
                 
         except Exception as e:
             print(f"[SERVER] Error handling client {address}: {e}")
-        finally:
             self.remove_client(client_socket)
     
+    def register_client(self, client_socket, registration):
+        """Register a client from its first message. Returns False if the connection was closed."""
+        if registration.get('type') != 'register':
+            self.remove_client(client_socket)
+            return False
+        
+        nickname = registration['content']
+        
+        if not self.valid_name(nickname):
+            self.send_message(client_socket, self.create_message(
+                "SERVER", "", "error", f"Nickname must be 1 to {MAX_NAME_LENGTH} characters long."
+            ))
+            self.remove_client(client_socket)
+            return False
+        
+        # Check if nickname is already in use
+        if nickname in self.nicknames:
+            self.send_message(client_socket, self.create_message(
+                "SERVER", nickname, "error", "Nickname already in use. Please choose another one."
+            ))
+            self.remove_client(client_socket)
+            return False
+        
+        # Register the client
+        self.clients[client_socket] = {"nickname": nickname, "channel": "general"}
+        self.nicknames[nickname] = client_socket
+        self.channels["general"].add(client_socket)
+        
+        # Notify the client of successful registration
+        welcome_msg = self.create_message("SERVER", nickname, "info", f"Welcome {nickname}! You are in the 'general' channel.")
+        self.send_message(client_socket, welcome_msg)
+        
+        # Notify other clients
+        join_msg = self.create_message("SERVER", "all", "info", f"{nickname} has joined the chat.")
+        self.broadcast(join_msg, exclude=client_socket)
+        
+        # Send list of available channels
+        channels_list = list(self.channels.keys())
+        channels_msg = self.create_message("SERVER", nickname, "channels_list", channels_list)
+        self.send_message(client_socket, channels_msg)
+        return True
+    
     def process_message(self, client_socket, message):
         """Process a message from a client."""
-        sender = self.clients[client_socket]['nickname']
-        
-        if message['type'] == 'chat':
-            # Regular chat message to current channel
-            current_channel = self.clients[client_socket]['channel']
-            forwarded_msg = self.create_message(sender, current_channel, 'chat', message['content'])
-            self.broadcast_to_channel(current_channel, forwarded_msg, exclude=None if message.get('echo', False) else client_socket)
-        
-        elif message['type'] == 'private':
-            # Private message to a specific user
-            recipient = message['recipient']
-            recipient_socket = None
-            
-            with self.lock:
-                for sock, info in self.clients.items():
-                    if info['nickname'] == recipient:
-                        recipient_socket = sock
-                        break
-            
-            if recipient_socket:
-                forwarded_msg = self.create_message(sender, recipient, 'private', message['content'])
-                self.send_message(recipient_socket, forwarded_msg)
-                
-                # Echo back to sender if they want to see their sent messages
-                if message.get('echo', False):
-                    self.send_message(client_socket, forwarded_msg)
-            else:
-                error_msg = self.create_message("SERVER", sender, "error", f"User '{recipient}' not found.")
-                self.send_message(client_socket, error_msg)
-        
-        elif message['type'] == 'join_channel':
-            # Join a channel
-            channel_name = message['content']
-            
-            with self.lock:
-                # Create channel if it doesn't exist
-                if channel_name not in self.channels:
-                    self.channels[channel_name] = set()
-                
-                # Remove from current channel
-                current_channel = self.clients[client_socket]['channel']
-                if current_channel:
-                    self.channels[current_channel].discard(client_socket)
-                
-                # Add to new channel
-                self.channels[channel_name].add(client_socket)
-                self.clients[client_socket]['channel'] = channel_name
-            
-            # Notify the client
-            channel_msg = self.create_message("SERVER", sender, "info", f"You joined channel '{channel_name}'")
-            self.send_message(client_socket, channel_msg)
-            
-            # Notify other users in the channel
-            join_msg = self.create_message("SERVER", channel_name, "info", f"{sender} has joined this channel.")
-            self.broadcast_to_channel(channel_name, join_msg, exclude=client_socket)
+        handler = self.message_handlers.get(message['type'])
+        if handler:
+            handler(client_socket, self.clients[client_socket]['nickname'], message)
+    
+    def process_chat(self, client_socket, sender, message):
+        """Forward a regular chat message to the sender's current channel."""
+        current_channel = self.clients[client_socket]['channel']
+        forwarded_msg = self.create_message(sender, current_channel, 'chat', message['content'])
+        self.broadcast_to_channel(current_channel, forwarded_msg, exclude=None if message.get('echo', False) else client_socket)
+    
+    def process_private(self, client_socket, sender, message):
+        """Forward a private message to a specific user."""
+        recipient = message['recipient']
+        recipient_socket = self.nicknames.get(recipient)
         
-        elif message['type'] == 'create_channel':
-            # Create a new channel
-            channel_name = message['content']
+        if recipient_socket:
+            forwarded_msg = self.create_message(sender, recipient, 'private', message['content'])
+            payload = self.encode_message(forwarded_msg)
+            header = FRAME_HEADER.pack(len(payload))
+            self.send_payload(recipient_socket, payload, header)
             
-            with self.lock:
-                if channel_name in self.channels:
-                    error_msg = self.create_message("SERVER", sender, "error", f"Channel '{channel_name}' already exists.")
-                    self.send_message(client_socket, error_msg)
-                else:
-                    self.channels[channel_name] = set()
-                    success_msg = self.create_message("SERVER", sender, "info", f"Channel '{channel_name}' created.")
-                    self.send_message(client_socket, success_msg)
-                    
-                    # Update all clients with new channel list
-                    channels_list = list(self.channels.keys())
-                    channels_msg = self.create_message("SERVER", "all", "channels_list", channels_list)
-                    self.broadcast(channels_msg)
-        
-        elif message['type'] == 'list_users':
-            # List users in the specified channel or current channel
-            channel_name = message.get('content', self.clients[client_socket]['channel'])
+            # Echo back to sender if they want to see their sent messages
+            if message.get('echo', False):
+                self.send_payload(client_socket, payload, header)
+        else:
+            error_msg = self.create_message("SERVER", sender, "error", f"User '{recipient}' not found.")
+            self.send_message(client_socket, error_msg)
+    
+    def process_join_channel(self, client_socket, sender, message):
+        """Move the sender to a channel, creating it if needed."""
+        channel_name = message['content']
+        
+        # Create channel if it doesn't exist
+        if channel_name not in self.channels:
+            error = self.check_new_channel(channel_name)
+            if error:
+                self.send_message(client_socket, self.create_message("SERVER", sender, "error", error))
+                return
+            self.channels[channel_name] = set()
+        
+        # Remove from current channel
+        current_channel = self.clients[client_socket]['channel']
+        if current_channel:
+            self.channels[current_channel].discard(client_socket)
+        
+        # Add to new channel
+        self.channels[channel_name].add(client_socket)
+        self.clients[client_socket]['channel'] = channel_name
+        
+        # Notify the client
+        channel_msg = self.create_message("SERVER", sender, "info", f"You joined channel '{channel_name}'")
+        self.send_message(client_socket, channel_msg)
+        
+        # Notify other users in the channel
+        join_msg = self.create_message("SERVER", channel_name, "info", f"{sender} has joined this channel.")
+        self.broadcast_to_channel(channel_name, join_msg, exclude=client_socket)
+    
+    def process_create_channel(self, client_socket, sender, message):
+        """Create a new channel."""
+        channel_name = message['content']
+        
+        if channel_name in self.channels:
+            error = f"Channel '{channel_name}' already exists."
+        else:
+            error = self.check_new_channel(channel_name)
+        
+        if error:
+            error_msg = self.create_message("SERVER", sender, "error", error)
+            self.send_message(client_socket, error_msg)
+        else:
+            self.channels[channel_name] = set()
+            success_msg = self.create_message("SERVER", sender, "info", f"Channel '{channel_name}' created.")
+            self.send_message(client_socket, success_msg)
             
-            with self.lock:
-                if channel_name in self.channels:
-                    users = [self.clients[sock]['nickname'] for sock in self.channels[channel_name]]
-                    users_msg = self.create_message("SERVER", sender, "users_list", users)
-                    self.send_message(client_socket, users_msg)
-                else:
-                    error_msg = self.create_message("SERVER", sender, "error", f"Channel '{channel_name}' does not exist.")
-                    self.send_message(client_socket, error_msg)
+            # Update all clients with new channel list
+            channels_list = list(self.channels.keys())
+            channels_msg = self.create_message("SERVER", "all", "channels_list", channels_list)
+            self.broadcast(channels_msg)
+    
+    def check_new_channel(self, channel_name):
+        """Return why a channel can't be created, or None if it can."""
+        if not self.valid_name(channel_name):
+            return f"Channel names must be 1 to {MAX_NAME_LENGTH} characters long."
+        if len(self.channels) >= MAX_CHANNELS:
+            return f"Channel limit of {MAX_CHANNELS} reached."
+        return None
+    
+    @staticmethod
+    def valid_name(name):
+        """Check that a nickname or channel name is a non-empty string within MAX_NAME_LENGTH."""
+        return isinstance(name, str) and 0 < len(name) <= MAX_NAME_LENGTH
+    
+    def process_list_users(self, client_socket, sender, message):
+        """List users in the specified channel or the sender's current channel."""
+        channel_name = message.get('content', self.clients[client_socket]['channel'])
+        
+        if channel_name in self.channels:
+            users = [self.clients[sock]['nickname'] for sock in self.channels[channel_name]]
+            users_msg = self.create_message("SERVER", sender, "users_list", users)
+            self.send_message(client_socket, users_msg)
+        else:
+            error_msg = self.create_message("SERVER", sender, "error", f"Channel '{channel_name}' does not exist.")
+            self.send_message(client_socket, error_msg)
     
     def remove_client(self, client_socket):
         """Remove a client from the server."""
-        with self.lock:
-            if client_socket in self.clients:
-                nickname = self.clients[client_socket]['nickname']
-                channel = self.clients[client_socket]['channel']
-                
-                # Remove from channel
-                if channel in self.channels:
-                    self.channels[channel].discard(client_socket)
-                
-                # Remove from clients dictionary
-                del self.clients[client_socket]
-                
-                # Notify other clients
-                leave_msg = self.create_message("SERVER", "all", "info", f"{nickname} has left the chat.")
-                self.broadcast(leave_msg)
+        if client_socket in self.connections:
+            self.selector.unregister(client_socket)
+            del self.connections[client_socket]
+            self.update_accepting()
+        
+        if client_socket in self.clients:
+            nickname = self.clients[client_socket]['nickname']
+            channel = self.clients[client_socket]['channel']
+            
+            # Remove from channel
+            if channel in self.channels:
+                self.channels[channel].discard(client_socket)
+            
+            # Remove from clients dictionary
+            del self.clients[client_socket]
+            del self.nicknames[nickname]
+            
+            # Notify other clients
+            leave_msg = self.create_message("SERVER", "all", "info", f"{nickname} has left the chat.")
+            self.broadcast(leave_msg)
         
         try:
             client_socket.close()
@@ -248,64 +395,146 @@ class ChatServer:
     
     def broadcast(self, message, exclude=None):
         """Broadcast a message to all connected clients."""
-        with self.lock:
-            for client_socket in list(self.clients.keys()):
-                if client_socket != exclude:
-                    try:
-                        self.send_message(client_socket, message)
-                    except:
-                        pass  # Client might be disconnected
+        self.fanout(self.clients, message, exclude)
     
     def broadcast_to_channel(self, channel, message, exclude=None):
         """Broadcast a message to all clients in a specific channel."""
-        if channel not in self.channels:
+        self.fanout(self.channels.get(channel, ()), message, exclude)
+    
+    def fanout(self, members, message, exclude=None):
+        """Send a message to every member except exclude, encoding it only if someone receives it."""
+        # Snapshot, membership may change while sending
+        targets = [client_socket for client_socket in members if client_socket != exclude]
+        if not targets:
             return
         
-        with self.lock:
-            for client_socket in list(self.channels[channel]):
-                if client_socket != exclude:
-                    try:
-                        self.send_message(client_socket, message)
-                    except:
-                        pass  # Client might be disconnected
+        # Every recipient shares the same header and payload bytes
+        payload = self.encode_message(message)
+        header = FRAME_HEADER.pack(len(payload))
+        for client_socket in targets:
+            try:
+                self.send_payload(client_socket, payload, header)
+            except:
+                pass  # Client might be disconnected
+    
+    @staticmethod
+    def enable_keepalive(client_socket):
+        """Enable TCP keepalive so dead peers are detected and removed."""
+        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        
+        # Linux-only tuning: probe after 60s idle, every 15s, give up after 4 misses
+        # or when sent data stays unacknowledged for 2 minutes
+        for option, value in (("TCP_KEEPIDLE", 60), ("TCP_KEEPINTVL", 15),
+                              ("TCP_KEEPCNT", 4), ("TCP_USER_TIMEOUT", 120000)):
+            if hasattr(socket, option):
+                client_socket.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
     
     @staticmethod
     def create_message(sender, recipient, msg_type, content):
-        """Create a formatted message."""
+        """Create a formatted message. Clients stamp messages with their own receive time."""
         return {
             'sender': sender,
             'recipient': recipient,
             'type': msg_type,
-            'content': content,
-            'timestamp': datetime.now().strftime("%H:%M:%S")
+            'content': content
         }
     
     @staticmethod
-    def send_message(client_socket, message):
+    def encode_message(message):
+        """Encode a message into a frame payload."""
+        return json_dumps(message)
+    
+    def send_message(self, client_socket, message):
         """Send a message to a client."""
+        self.send_payload(client_socket, self.encode_message(message))
+    
+    def send_payload(self, client_socket, payload, header=None):
+        """Queue an encoded message for a client, with its frame header if already packed."""
+        connection = self.connections.get(client_socket)
+        if connection is None:
+            return  # Client already disconnected
+        
+        outq = connection['outq']
+        was_idle = not outq
+        outq.append(header or FRAME_HEADER.pack(len(payload)))
+        outq.append(payload)
+        connection['outq_bytes'] += FRAME_HEADER.size + len(payload)
+        
+        if was_idle:
+            self.flush_client(client_socket)
+            if client_socket not in self.connections:
+                return  # Write failed and the client was removed
+        
+        # Judge the client on what it has not taken yet, not on the frame just queued
+        if connection['outq_bytes'] > MAX_OUTQ_BYTES:
+            print(f"[SERVER] Dropping client {connection['address']}: too far behind on output")
+            self.remove_client(client_socket)
+    
+    def flush_client(self, client_socket):
+        """Write as much queued output to a client as its socket accepts."""
+        connection = self.connections[client_socket]
+        outq = connection['outq']
         try:
-            message_json = json.dumps(message)
-            message_bytes = (message_json + '\n').encode('utf-8')
-            client_socket.sendall(message_bytes)
-        except Exception as e:
-            raise Exception(f"Failed to send message: {e}")
+            while outq:
+                if HAS_SENDMSG:
+                    # Gather queued headers and payloads into one syscall without joining them
+                    sent = client_socket.sendmsg(list(islice(outq, SENDMSG_MAX_BUFFERS)))
+                else:
+                    sent = client_socket.send(outq[0])
+                connection['outq_bytes'] -= sent
+                
+                # Drop fully written buffers and keep the unsent tail of a partial one
+                while sent:
+                    data = outq[0]
+                    if sent < len(data):
+                        outq[0] = memoryview(data)[sent:]
+                        break
+                    sent -= len(data)
+                    outq.popleft()
+        except BlockingIOError:
+            pass  # Socket buffer is full, wait until it becomes writable
+        except OSError:
+            self.remove_client(client_socket)
+            return
+        
+        # Only ask to be woken for writing while output is pending
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if outq else 0)
+        if self.selector.get_key(client_socket).events != events:
+            self.selector.modify(client_socket, events, self.handle_client)
     
-    @staticmethod
-    def receive_message(client_socket):
-        """Receive a message from a client."""
+    def receive_messages(self, client_socket, connection):
+        """Read available data from a client. Returns (complete messages, whether to keep the connection)."""
+        messages = []
         try:
-            buffer = ""
-            while True:
-                data = client_socket.recv(4096).decode('utf-8')
-                if not data:
-                    return None  # Client disconnected
+            nbytes = client_socket.recv_into(self.rxchunk)
+            if not nbytes:
+                return messages, False  # Client disconnected
+            
+            # Keep the connection's buffer between reads so partial and pipelined frames survive
+            rxbuf = connection['rxbuf']
+            rxbuf.extend(self.rxview[:nbytes])
+            relax = False
+            while len(rxbuf) >= FRAME_HEADER.size:
+                length = FRAME_HEADER.unpack_from(rxbuf)[0]
+                if length > MAX_FRAME_SIZE:
+                    print(f"[SERVER] Frame of {length} bytes from {connection['address']} exceeds limit")
+                    return messages, False  # Never buffer an unbounded frame
                 
-                buffer += data
-                if '\n' in buffer:
-                    message_json, buffer = buffer.split('\n', 1)
-                    return json.loads(message_json)
+                end = FRAME_HEADER.size + length
+                if len(rxbuf) < end:
+                    break  # Wait for the rest of the frame
+                messages.append(json_loads(rxbuf[FRAME_HEADER.size:end]))
+                del rxbuf[:end]
+                relax = relax or end > RECV_CHUNK_SIZE
+            
+            if relax:
+                # A large frame grew the buffer, copy the tail so the memory goes back to the allocator
+                connection['rxbuf'] = bytearray(rxbuf)
+            return messages, True
+        except BlockingIOError:
+            return messages, True  # Spurious wakeup, nothing to read yet
         except Exception:
-            return None  # Error receiving message
+            return messages, False  # Error receiving message
 
 
 if __name__ == "__main__":